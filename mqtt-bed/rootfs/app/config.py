@@ -1,21 +1,34 @@
 # mqtt-bed config
+from dataclasses import dataclass
+from typing import Optional
 
-BED_ADDRESS = "DC:BB:48:42:D9:3E"
 
-MQTT_USERNAME = "mqttbed"
-MQTT_PASSWORD = "mqtt-bed"
-MQTT_SERVER = "10.0.0.3"
-MQTT_SERVER_PORT = 1883
-MQTT_TOPIC = "bed"
+@dataclass(frozen=True)
+class Config:
+    bed_address: Optional[str] = None
+    mqtt_username: str = "mqttbed"
+    mqtt_password: str = "mqtt-bed"
+    mqtt_server: str = "127.0.0.1"
+    mqtt_server_port: int = 1883
+    mqtt_topic: str = "bed"
+    # Bed controller type, supported values are "serta", "jiecang", "lucid", and "dewertokin"
+    bed_type: str = "lucid"
+    # Don't worry about these unless you want to
+    mqtt_checkin_topic: str = "checkIn/bed"
+    mqtt_checkin_payload: str = "OK"
+    mqtt_online_payload: str = "online"
+    mqtt_qos: int = 0
+    # Extra debug messages
+    debug: bool = False
 
-# Bed controller type, supported values are "serta", "jiecang", "lucid", and "dewertokin"
-BED_TYPE = "lucid"
 
-# Don't worry about these unless you want to
-MQTT_CHECKIN_TOPIC = "checkIn/bed"
-MQTT_CHECKIN_PAYLOAD = "OK"
-MQTT_ONLINE_PAYLOAD = "online"
-MQTT_QOS = 0
-
-# Extra debug messages
-DEBUG = 1
+CONFIG = Config(
+    bed_address="DC:BB:48:42:D9:3E",
+    mqtt_username="mqttbed",
+    mqtt_password="mqtt-bed",
+    mqtt_server="10.0.0.3",
+    mqtt_server_port=1883,
+    mqtt_topic="bed",
+    bed_type="lucid",
+    debug=True,
+)
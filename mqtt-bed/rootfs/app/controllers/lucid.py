@@ -2,117 +2,250 @@
 # Imports
 # ---------------------------------------------------------------------------
 import bluepy.btle as ble
+import logging
+import random
 import time
 import threading
+import types
+
+_COMMANDS_HEX = {
+    "Flat Preset":        "e6fe160000000800fd",
+    "ZeroG Preset":       "e6fe160010000000f5",
+    "TV Preset":          "e6fe160040000000c5",
+    "Lounge Preset":      "e6fe160020000000e5",
+    "Quiet Sleep":        "e6fe16008000000085",
+    "Memory 1":           "e6fe16000001000004",
+    "Memory 2":           "e6fe16000004000001",
+    "Underlight":         "e6fe16000002000003",
+    "Lift Head":          "e6fe16010000000004",
+    "Lower Head":         "e6fe16020000000003",
+    "Lift Foot":          "e6fe16040000000001",
+    "Lower Foot":         "e6fe160800000000fd",
+    "Massage Toggle":     "e6fe16000100000004",
+    # Note: Wave cycles "On High", "On Medium", "On Low", "Off"
+    "Wave Massage Cycle": "e6fe160000001000f5",
+    # Note: Head and Foot cycles "On Low, "On Medium", "On High", "Off"
+    "Head Massage Cycle": "e6fe160008000000fd",
+    "Foot Massage Cycle": "e6fe16000400000001",
+    "Massage Timer":      "e6fe16000200000003",
+    "Keepalive NOOP":     "e6fe16000000000005",
+}
+# The payloads never change, so decode them once at import and share them read-only.
+_COMMANDS = types.MappingProxyType({k: bytes.fromhex(v) for k, v in _COMMANDS_HEX.items()})
 
 class lucidBLEController:
+    # Retry delays grow exponentially from BASE_DELAY up to MAX_BACKOFF seconds,
+    # with full jitter so that restarted containers don't retry in lockstep.
+    BASE_DELAY = 0.5
+    MAX_BACKOFF = 30
+    KEEPALIVE_ATTEMPTS = 3
+    KEEPALIVE_INTERVAL = 10
+    # After FAILURE_THRESHOLD consecutive failed commands, drop commands for OPEN_SECONDS
+    # rather than blocking on another write timeout and reconnect for every message.
+    FAILURE_THRESHOLD = 3
+    OPEN_SECONDS = 30
+    # A queued command older than this is dropped rather than moving the bed late.
+    PENDING_MAX_AGE = 3
+
     def __init__(self, addr):
-        self.charWriteInProgress = False
-        self.charWriteStart = None
+        self.logger = logging.getLogger(__name__)
+        # Serialises every operation on the bluepy Peripheral, which is not thread-safe.
+        self.charWriteInProgress = threading.Lock()
+        self._consecutive_failures = 0
+        self._circuit_open_until = 0.0
+        # Set by stop() to wake any backoff or wait and let the background threads exit.
+        self._stop = threading.Event()
+        # Looked up on the first connect and reused by every reconnect; the bed's GATT table doesn't change.
+        self._control_char = None
+        # Bumped on every successful connect, so a thread can tell another one already reconnected.
+        self._connection_generation = 0
+        # When a command last went through; the link is known to be up until KEEPALIVE_INTERVAL after it.
+        self._last_command = 0.0
+        # Single-slot, latest-wins command queue drained by the writer thread: (cmd, time queued).
+        self._pending = None
+        self._pending_cv = threading.Condition()
         self.addr = addr
-        self.commands = {
-            "Flat Preset":        "e6fe160000000800fd",
-            "ZeroG Preset":       "e6fe160010000000f5",
-            "TV Preset":          "e6fe160040000000c5",
-            "Lounge Preset":      "e6fe160020000000e5",
-            "Quiet Sleep":        "e6fe16008000000085",
-            "Memory 1":           "e6fe16000001000004",
-            "Memory 2":           "e6fe16000004000001",
-            "Underlight":         "e6fe16000002000003",
-            "Lift Head":          "e6fe16010000000004",
-            "Lower Head":         "e6fe16020000000003",
-            "Lift Foot":          "e6fe16040000000001",
-            "Lower Foot":         "e6fe160800000000fd",
-            "Massage Toggle":     "e6fe16000100000004",
-            # Note: Wave cycles "On High", "On Medium", "On Low", "Off"
-            "Wave Massage Cycle": "e6fe160000001000f5",
-            # Note: Head and Foot cycles "On Low, "On Medium", "On High", "Off"
-            "Head Massage Cycle": "e6fe160008000000fd",
-            "Foot Massage Cycle": "e6fe16000400000001",
-            "Massage Timer":      "e6fe16000200000003",
-            "Keepalive NOOP":     "e6fe16000000000005",
-        }
+        self.commands = _COMMANDS
+        self._keepalive = self.commands["Keepalive NOOP"]
         # Initialise the adapter and connect to the bed before we start waiting for messages.
+        # The same Peripheral is reused for every reconnect.
+        self.device = ble.Peripheral()
         self.connectBed(ble)
         # Start the background polling/keepalive/heartbeat function.
         thread = threading.Thread(target=self.bluetoothPoller, args=())
         thread.daemon = True
         thread.start()
+        # Start the command writer, so sendCommand never blocks on Bluetooth.
+        thread = threading.Thread(target=self.commandWriter, args=())
+        thread.daemon = True
+        thread.start()
 
     # There seem to be a lot of conditions that cause the bed to disconnect Bluetooth.
     # Here we use the value of 040200000000, which seems to be a noop.
     # This lets us poll the bed, detect a disconnection and reconnect before the user notices.
     def bluetoothPoller(self):
-       print("Starting keep-alive thread")
-       while True:
-           if self.charWriteInProgress is False:
+       self.logger.info("Starting keep-alive thread")
+       while not self._stop.is_set():
+           # A successful command proves the link just as well as a keepalive would,
+           # so while the user is pressing buttons don't spend BLE round-trips on NOOPs.
+           idle = time.monotonic() - self._last_command
+           if idle < self.KEEPALIVE_INTERVAL:
+               self.logger.debug("Command sent recently, keepalive skipped.")
+               self._stop.wait(self.KEEPALIVE_INTERVAL - idle)
+               continue
+
+           generation = self._connection_generation
+           for attempt in range(self.KEEPALIVE_ATTEMPTS):
                try:
-                   cmd = self.commands.get("Keepalive NOOP", None)
-                   self.device.getServiceByUUID(0xffe5).getCharacteristics(0xffe9)[0].write(bytes.fromhex(cmd), withResponse=True)
-                   print("Keepalive success!")
+                   with self.charWriteInProgress:
+                       self._control_char.write(self._keepalive, withResponse=True)
+                   self.logger.debug("Keepalive success!")
+                   self._record_success()
+                   break
                except:
-                   print("Keepalive failed! (1/2)")
-                   try:
-                       # We perform a second keepalive check 0.5 seconds later before reconnecting.
-                       time.sleep(0.5)
-                       cmd = self.commands.get("Keepalive NOOP", None)
-                       self.device.getServiceByUUID(0xffe5).getCharacteristics(0xffe9)[0].write(bytes.fromhex(cmd), withResponse=True)
-                       print("Keepalive success!")
-                   except:
-                       # If both keepalives failed, we reconnect.
-                       print("Keepalive failed! (2/2)")
-                       self.connectBed(ble)
+                   self.logger.warning("Keepalive failed! (%d/%d)", attempt + 1, self.KEEPALIVE_ATTEMPTS)
+                   if attempt + 1 < self.KEEPALIVE_ATTEMPTS:
+                       # Back off briefly before checking again.
+                       self._backoff_sleep(attempt)
            else:
-               # To minimise any chance of contention, we don't heartbeat if a charWrite is in progress.
-               print("charWrite in progress, heartbeat skipped.")
-               if self.charWriteStart is not None and time.time() - self.charWriteStart > 30:
-                 print("charWrite in progress for 30 seconds, exiting now")
-                 sys.exit()
+               # If every keepalive failed, we reconnect.
+               self.connectBed(ble, generation=generation)
 
-           time.sleep(10)
+           self._stop.wait(self.KEEPALIVE_INTERVAL)
 
-    # Separate out the bed connection to an infinite loop that can be called on init (or a communications failure).
-    def connectBed(self, ble):
-        while True:
-            try:
-                print("Attempting to connect to bed.")
-                self.device = ble.Peripheral(deviceAddr=self.addr, addrType='random')
-                print("Connected to bed.")
-                return
-            except:
-                pass
-            print("Error connecting to bed, retrying in one second.")
-            time.sleep(1)
+    # Separate out the bed connection to a loop that can be called on init (or a communications failure).
+    # It retries until connected unless max_attempts is given, and returns whether it connected.
+    # The lock is only held for each attempt, so commands can fail fast while we back off.
+    # Pass the connection generation seen when the link failed: if another thread has reconnected
+    # since, the working link is kept rather than torn down again.
+    def connectBed(self, ble, max_attempts=None, generation=None):
+        attempt = 0
+        while not self._stop.is_set():
+            with self.charWriteInProgress:
+                if generation is not None and generation != self._connection_generation:
+                    self.logger.info("Bed already reconnected.")
+                    return True
+                try:
+                    self.logger.info("Attempting to connect to bed.")
+                    # Tear down any previous connection so its bluepy-helper doesn't linger.
+                    try:
+                        self.device.disconnect()
+                    except:
+                        pass
+                    self.device.connect(self.addr, addrType='random')
+                    if self._control_char is None:
+                        self._control_char = self.device.getCharacteristics(uuid=0xffe9)[0]
+                    self._connection_generation += 1
+                    self.logger.info("Connected to bed.")
+                    return True
+                except:
+                    pass
+            attempt += 1
+            if max_attempts is not None and attempt >= max_attempts:
+                self.logger.warning("Error connecting to bed, giving up.")
+                return False
+            self.logger.warning("Error connecting to bed, backing off before retrying.")
+            self._backoff_sleep(attempt - 1)
+        return False
 
-    # Separate out the command handling.
+    # Sleep for a random delay of up to BASE_DELAY * 2^attempt seconds, capped at MAX_BACKOFF ("full jitter").
+    def _backoff_sleep(self, attempt):
+        delay = min(self.MAX_BACKOFF, self.BASE_DELAY * (2 ** min(attempt, 16))) * random.random()
+        self._stop.wait(delay)
+
+    # Queue a command for the writer thread. A command still waiting to be sent is replaced
+    # by the newest one, so a burst of button presses doesn't keep the bed moving afterwards.
     def sendCommand(self,name):
         cmd = self.commands.get(name, None)
         if cmd is None:
-            # print, but otherwise ignore Unknown Commands.
-            # print("Unknown Command, ignoring.")
-            # return
-            cmd = name
-        self.charWriteInProgress = True
-        self.charWriteStart = time.time()
+            # Raw hex payloads are sent as-is; anything else is logged and ignored.
+            try:
+                cmd = bytes.fromhex(name)
+            except ValueError:
+                self.logger.warning("Unknown Command %r, ignoring.", name)
+                return
+        with self._pending_cv:
+            self._pending = (cmd, time.monotonic())
+            self._pending_cv.notify()
+
+    def commandWriter(self):
+        while True:
+            with self._pending_cv:
+                while self._pending is None and not self._stop.is_set():
+                    self._pending_cv.wait()
+                if self._stop.is_set():
+                    return
+                cmd, queued = self._pending
+                self._pending = None
+            self._do_write(cmd, queued)
+
+    def _is_stale(self, queued):
+        if time.monotonic() - queued > self.PENDING_MAX_AGE:
+            self.logger.warning("Command queued more than %d seconds ago, dropping command.", self.PENDING_MAX_AGE)
+            return True
+        return False
+
+    # Separate out the command handling.
+    def _do_write(self, cmd, queued):
+        if time.monotonic() < self._circuit_open_until:
+            self.logger.warning("Bed unreachable, circuit open, dropping command.")
+            return
+        generation = self._connection_generation
         try:
-            self.charWrite(cmd)
+            with self.charWriteInProgress:
+                if self._is_stale(queued):
+                    return
+                self.charWrite(cmd)
+            return
         except:
-            print("Error sending command, attempting reconnect.")
-            start = time.time()
-            self.connectBed(ble)
-            end = time.time()
-            if ((end - start) < 5):
-                try:
-                    self.charWrite(self, cmd)
-                except:
-                    print("Command failed to transmit despite second attempt, dropping command.")
-            else:
-                print("Bluetooth reconnect took more than five seconds, dropping command.")
-        self.charWriteInProgress = False
+            # Each failed command counts once against the breaker, however it fails from here on.
+            self._record_failure()
+            if time.monotonic() < self._circuit_open_until:
+                self.logger.warning("Error sending command, circuit open, dropping command.")
+                return
+            self.logger.warning("Error sending command, attempting reconnect.")
+        # Only try to reconnect once here; the keepalive thread keeps retrying during a longer outage.
+        start = time.monotonic()
+        connected = self.connectBed(ble, max_attempts=1, generation=generation)
+        end = time.monotonic()
+        if not connected:
+            self.logger.error("Bluetooth reconnect failed, dropping command.")
+        elif ((end - start) < 5):
+            try:
+                with self.charWriteInProgress:
+                    if self._is_stale(queued):
+                        return
+                    self.charWrite(cmd)
+            except:
+                self.logger.error("Command failed to transmit despite second attempt, dropping command.")
+        else:
+            self.logger.error("Bluetooth reconnect took more than five seconds, dropping command.")
 
     # Separate charWrite function.
     def charWrite(self, cmd):
-        print("Attempting to transmit command.")
-        self.device.getServiceByUUID(0xffe5).getCharacteristics(0xffe9)[0].write(bytes.fromhex(cmd), withResponse=True)
-        print("Command sent successfully.")
-        return
\ No newline at end of file
+        self.logger.debug("Attempting to transmit command.")
+        self._control_char.write(cmd, withResponse=True)
+        self.logger.debug("Command sent successfully.")
+        self._last_command = time.monotonic()
+        self._record_success()
+        return
+
+    # Ask the keepalive and writer threads to finish, interrupting any backoff in progress.
+    def stop(self):
+        self._stop.set()
+        with self._pending_cv:
+            self._pending_cv.notify_all()
+
+    # Any successful write closes the circuit again.
+    def _record_success(self):
+        self._consecutive_failures = 0
+        self._circuit_open_until = 0.0
+
+    def _record_failure(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.FAILURE_THRESHOLD:
+            self.logger.error("%d consecutive failures, dropping commands for %d seconds.",
+                              self._consecutive_failures, self.OPEN_SECONDS)
+            self._circuit_open_until = time.monotonic() + self.OPEN_SECONDS
+            with self._pending_cv:
+                self._pending = None
\ No newline at end of file
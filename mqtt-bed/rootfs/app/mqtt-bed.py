@@ -2,6 +2,8 @@
 
 import os
 import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AsyncExitStack, asynccontextmanager
 from asyncio_mqtt import Client, MqttError
 
@@ -10,23 +12,14 @@ from controllers.jiecang import jiecangBLEController
 from controllers.serta import sertaBLEController
 from controllers.lucid import lucidBLEController
 
-# mqtt-bed default config values. Set these in config.py yourself.
-MQTT_USERNAME = "mqttbed"
-MQTT_PASSWORD = "mqtt-bed"
-MQTT_SERVER = "127.0.0.1"
-MQTT_SERVER_PORT = 1883
-MQTT_TOPIC = "bed"
-MQTT_CHECKIN_TOPIC = "checkIn/bed"
-MQTT_CHECKIN_PAYLOAD = "OK"
-MQTT_ONLINE_PAYLOAD = "online"
-MQTT_QOS = 0
-DEBUG = 0
-BED_TYPE = "lucid"
+# mqtt-bed config values. Set these in config.py yourself.
+from config import CONFIG
 
-from config import *
+logging.basicConfig(level=logging.DEBUG if CONFIG.debug else logging.INFO)
+logger = logging.getLogger(__name__)
 
 
-async def bed_loop(ble):
+async def bed_loop(ble, executor):
     async with AsyncExitStack() as stack:
         # Keep track of the asyncio tasks that we create, so that
         # we can cancel them on exit
@@ -35,30 +28,29 @@ async def bed_loop(ble):
 
         # Connect to the MQTT broker
         client = Client(
-            MQTT_SERVER,
-            port=MQTT_SERVER_PORT,
-            username=MQTT_USERNAME,
-            password=MQTT_PASSWORD,
+            CONFIG.mqtt_server,
+            port=CONFIG.mqtt_server_port,
+            username=CONFIG.mqtt_username,
+            password=CONFIG.mqtt_password,
         )
         await stack.enter_async_context(client)
 
         # Set up the topic filter
-        manager = client.filtered_messages(MQTT_TOPIC)
+        manager = client.filtered_messages(CONFIG.mqtt_topic)
         messages = await stack.enter_async_context(manager)
-        task = asyncio.create_task(bed_command(ble, messages))
+        task = asyncio.create_task(bed_command(ble, executor, messages))
         tasks.add(task)
 
         # Subscribe to topic(s)
-        await client.subscribe(MQTT_TOPIC)
+        await client.subscribe(CONFIG.mqtt_topic)
 
         # let everyone know we are online
-        if DEBUG:
-            print("Going online")
-        await client.publish(MQTT_CHECKIN_TOPIC, MQTT_ONLINE_PAYLOAD, qos=1)
+        logger.debug("Going online")
+        await client.publish(CONFIG.mqtt_checkin_topic, CONFIG.mqtt_online_payload, qos=1)
 
         # let everyone know we are still alive
         task = asyncio.create_task(
-            check_in(client, MQTT_CHECKIN_TOPIC, MQTT_CHECKIN_PAYLOAD)
+            check_in(client, CONFIG.mqtt_checkin_topic, CONFIG.mqtt_checkin_payload)
         )
         tasks.add(task)
 
@@ -69,18 +61,18 @@ async def bed_loop(ble):
 
 async def check_in(client, topic, payload):
     while True:
-        if DEBUG:
-            print(f'[topic="{topic}"] Publishing message={payload}')
+        logger.debug('[topic="%s"] Publishing message=%s', topic, payload)
         await client.publish(topic, payload, qos=1)
         await asyncio.sleep(300)
 
 
-async def bed_command(ble, messages):
+async def bed_command(ble, executor, messages):
+    loop = asyncio.get_running_loop()
     async for message in messages:
-        if DEBUG:
-            template = f'[topic_filter="{MQTT_TOPIC}"] {{}}'
-            print(template.format(message.payload.decode()))
-        ble.sendCommand(message.payload.decode())
+        logger.debug('[topic_filter="%s"] %s', CONFIG.mqtt_topic, message.payload.decode())
+        # The controllers talk Bluetooth synchronously, so run them off the event loop
+        # to keep the MQTT client responsive while a command is being sent.
+        await loop.run_in_executor(executor, ble.sendCommand, message.payload.decode())
 
 
 async def cancel_tasks(tasks):
@@ -96,32 +88,41 @@ async def cancel_tasks(tasks):
 
 async def main():
 
-    ble_address = os.environ.get("BLE_ADDRESS", BED_ADDRESS)
+    ble_address = os.environ.get("BLE_ADDRESS", CONFIG.bed_address)
 
     if ble_address is None:
         raise Exception("BLE_ADDRESS env not set")
 
-    if BED_TYPE == "serta":
+    if CONFIG.bed_type == "serta":
         ble = sertaBLEController(ble_address)
-    elif BED_TYPE == "jiecang":
+    elif CONFIG.bed_type == "jiecang":
         ble = jiecangBLEController(ble_address)
-    elif BED_TYPE == "lucid":
+    elif CONFIG.bed_type == "lucid":
         ble = lucidBLEController(ble_address)
-    elif BED_TYPE == "dewertokin":
+    elif CONFIG.bed_type == "dewertokin":
         ble = dewertokinBLEController(ble_address)
     else:
-        raise Exception("Unrecognised bed type: " + str(BED_TYPE))
+        raise Exception("Unrecognised bed type: " + str(CONFIG.bed_type))
+
+    # A single worker keeps commands in order and never talks to the bed concurrently.
+    executor = ThreadPoolExecutor(max_workers=1)
 
     # Run the bed_loop indefinitely. Reconnect automatically
     # if the connection is lost.
     reconnect_interval = 3  # [seconds]
-    while True:
-        try:
-            await bed_loop(ble)
-        except MqttError as error:
-            print(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
-        finally:
-            await asyncio.sleep(reconnect_interval)
+    try:
+        while True:
+            try:
+                await bed_loop(ble, executor)
+            except MqttError as error:
+                logger.warning('Error "%s". Reconnecting in %d seconds.', error, reconnect_interval)
+            finally:
+                await asyncio.sleep(reconnect_interval)
+    finally:
+        # Let controllers with background threads wind them down.
+        if hasattr(ble, "stop"):
+            ble.stop()
+        executor.shutdown(wait=False)
 
 
 asyncio.run(main())